@@ -1,18 +1,111 @@
+import asyncio
 import requests
-from bs4 import BeautifulSoup
-import urllib.parse
+import httpx
+import orjson
+from aiolimiter import AsyncLimiter
 import configparser
 from http import HTTPStatus
 import logging
+import math
+import functools
+import os
+import io
+import sys
+import html
+import re
+import sqlite3
+import time
 from collections import Counter
+from itertools import chain
+from typing import TextIO
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
+from tqdm.asyncio import tqdm as atqdm
 
 logging.basicConfig(level=logging.WARNING)
 logger = logging.getLogger(__name__)
 
-config = configparser.ConfigParser()
-config.read("config.toml")
-API_KEY = config["TMDB"]["key"]
+
+@functools.cache
+def load_api_key() -> str:
+    """
+    Load TMDB API key from TMDB_API_KEY environment variable or, if it is not
+    set, from config.toml file. The key is loaded only once.
+
+    Returns
+    -------
+    str
+        TMDB API key
+
+    Raises
+    ------
+    RuntimeError
+        If API key is neither in the environment variable nor in config.toml
+    """
+    if api_key := os.environ.get("TMDB_API_KEY"):
+        return api_key
+
+    config = configparser.ConfigParser()
+    config.read("config.toml")
+    # Value is quoted in toml, but configparser keeps the quotes
+    if api_key := config.get("TMDB", "key", fallback="").strip("\"'"):
+        return api_key
+
+    raise RuntimeError(
+        "TMDB API key not found, set TMDB_API_KEY environment variable "
+        "or 'key' in [TMDB] section of config.toml"
+    )
+
+
+# TMDB allows 40 requests per 10 seconds
+TMDB_RATE_LIMIT = 40
+TMDB_RATE_PERIOD = 10
+TMDB_MAX_RETRIES = 3
+TMDB_TIMEOUT = 30
+
+SEPARATOR = "*" * 50
+
+# The html is not fully rendered, so we need to get the title from the img alt
+# attribute. Only titles and movies count are needed from watchlist pages, so
+# they are extracted with regexes instead of building the whole html tree.
+# Each match is kept within a single poster, so posters without an img don't
+# borrow the title of the next poster or of an img further down the page.
+TITLE_RE = re.compile(
+    r'poster-container[^>]*>(?:(?!poster-container|</li>).)*?<img[^>]*\salt="([^"]*)"',
+    re.DOTALL,
+)
+# Matches: 'self.username' WANTS TO SEE 'movies_count' FILMS
+COUNT_RE = re.compile(r"section-heading[^>]*>[^<]*?([\d,]+)\s+\w+\s*<")
+# Matches links to other watchlist pages in the pagination
+PAGE_RE = re.compile(r"paginate-page[^>]*>\s*<a[^>]*>(\d+)</a>")
+
+
+def parse_titles(page_html: str) -> list[str]:
+    """
+    Get titles of the movies from watchlist page. Posters without an img or
+    with an empty alt attribute are skipped.
+
+    Parameters
+    ----------
+    page_html : str
+        Watchlist page as a string
+
+    Returns
+    -------
+    list[str]
+        Titles of the movies on the page
+
+    Examples
+    --------
+    >>> parse_titles(
+    ...     '<li class="poster-container"><div></div></li>'
+    ...     '<li class="poster-container"><img src="a" alt="Tom &amp; Jerry"/></li>'
+    ...     '<li class="poster-container"><img src="b" alt=""/></li>'
+    ...     '<footer><img src="logo" alt="Letterboxd"/></footer>'
+    ... )
+    ['Tom & Jerry']
+    """
+    return [html.unescape(title) for title in TITLE_RE.findall(page_html) if title]
 
 
 class Scrapper:
@@ -28,6 +121,8 @@ class Scrapper:
         If True, requests will be made using sessions, by default True
     """
 
+    __slots__ = ("url", "headers", "requests")
+
     def __init__(self, url: str, use_sessions=True):
         self.url = url
         self.headers = {
@@ -53,7 +148,9 @@ class Scrapper:
 
 
 class Movie:
-    def __init__(self, title: str, platforms: list[str] = []):
+    __slots__ = ("title", "platforms")
+
+    def __init__(self, title: str, platforms: list[str] | None = None):
         """
         Movie class that holds information about movie title and streaming
         platforms that it is available on.
@@ -62,11 +159,12 @@ class Movie:
         ----------
         title : str
             Title of the movie
-        platforms : list[str], optional
-            List of streaming platforms that the movie is available on, by default []
+        platforms : list[str] | None, optional
+            List of streaming platforms that the movie is available on,
+            by default None (no platforms)
         """
         self.title = title
-        self.platforms = platforms
+        self.platforms = sorted(platforms or [])
 
     @property
     def available(self) -> bool:
@@ -85,29 +183,289 @@ class Movie:
             return (
                 f"Movie: {self.title}\n\n"
                 + "Platforms \n---------- \n"
-                + "\n".join(sorted(self.platforms))
+                + "\n".join(self.platforms)
             )
         return f"Movie: {self.title}\nNot available on any streaming platform"
 
 
+class TMDBCache:
+    """
+    Persistent cache for TMDB lookups, backed by a SQLite database, so that
+    repeated runs don't query the API again for already seen movies.
+
+    Parameters
+    ----------
+    path : str, optional
+        Path to the SQLite database file, by default ".tmdb_cache.sqlite"
+    providers_ttl : float, optional
+        Number of seconds after which cached watch providers expire,
+        by default 24 hours. Movie ids never expire.
+    """
+
+    __slots__ = (
+        "path",
+        "providers_ttl",
+        "connection",
+        "pending_movie_ids",
+        "pending_watch_providers",
+    )
+
+    def __init__(
+        self, path: str = ".tmdb_cache.sqlite", providers_ttl: float = 24 * 60 * 60
+    ):
+        self.path = path
+        self.providers_ttl = providers_ttl
+        self.connection: sqlite3.Connection | None = None
+
+        # Writes are kept in memory and committed in a single transaction, so
+        # lookups running on the event loop don't block on SQLite commits
+        self.pending_movie_ids: dict[str, int] = {}
+        self.pending_watch_providers: dict[int, tuple[dict, float]] = {}
+
+    def open(self):
+        """
+        Open connection to the SQLite database and create missing tables.
+        """
+        self.connection = sqlite3.connect(self.path)
+
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS movie_ids ("
+                "title TEXT PRIMARY KEY, movie_id INTEGER NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS watch_providers ("
+                "movie_id INTEGER PRIMARY KEY, results TEXT NOT NULL, "
+                "fetched_at REAL NOT NULL)"
+            )
+
+    def commit(self):
+        """
+        Write all pending entries to the SQLite database in a single transaction.
+        """
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO movie_ids VALUES (?, ?)",
+                self.pending_movie_ids.items(),
+            )
+            providers = self.pending_watch_providers.items()
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO watch_providers VALUES (?, ?, ?)",
+                [
+                    (movie_id, orjson.dumps(results), fetched_at)
+                    for movie_id, (results, fetched_at) in providers
+                ],
+            )
+
+        self.pending_movie_ids.clear()
+        self.pending_watch_providers.clear()
+
+    def close(self):
+        """
+        Commit pending entries and close connection to the SQLite database.
+        """
+        self.commit()
+        self.connection.close()
+        self.connection = None
+
+    def get_movie_id(self, title: str) -> int | None:
+        """
+        Get cached movie id.
+
+        Parameters
+        ----------
+        title : str
+            Title of the movie
+
+        Returns
+        -------
+        int | None
+            Movie id or None if it is not cached
+        """
+        if (movie_id := self.pending_movie_ids.get(title)) is not None:
+            return movie_id
+
+        row = self.connection.execute(
+            "SELECT movie_id FROM movie_ids WHERE title = ?", (title,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_movie_id(self, title: str, movie_id: int):
+        """
+        Store movie id in the cache. It is written to the database on commit.
+
+        Parameters
+        ----------
+        title : str
+            Title of the movie
+        movie_id : int
+            Movie id
+        """
+        self.pending_movie_ids[title] = movie_id
+
+    def get_watch_providers(self, movie_id: int) -> dict | None:
+        """
+        Get cached watch providers for all countries, if they haven't expired yet.
+
+        Parameters
+        ----------
+        movie_id : int
+            Movie id
+
+        Returns
+        -------
+        dict | None
+            Watch providers keyed by country or None if they are not cached
+        """
+        if (pending := self.pending_watch_providers.get(movie_id)) is not None:
+            return pending[0]
+
+        row = self.connection.execute(
+            "SELECT results, fetched_at FROM watch_providers WHERE movie_id = ?",
+            (movie_id,),
+        ).fetchone()
+        if row is None or time.time() - row[1] > self.providers_ttl:
+            return None
+
+        return orjson.loads(row[0])
+
+    def set_watch_providers(self, movie_id: int, results: dict):
+        """
+        Store watch providers for all countries in the cache. They are written
+        to the database on commit.
+
+        Parameters
+        ----------
+        movie_id : int
+            Movie id
+        results : dict
+            Watch providers keyed by country, as returned by TMDB API
+        """
+        self.pending_watch_providers[movie_id] = (results, time.time())
+
+
 class TMDB:
-    def __init__(self, country: str):
+    __slots__ = (
+        "country",
+        "api_key",
+        "url",
+        "cache",
+        "headers",
+        "client",
+        "limiter",
+    )
+
+    def __init__(self, country: str, cache: TMDBCache | None = None):
         """
         Parameters
         ----------
         country : str
             _description_
+        cache : TMDBCache | None, optional
+            Cache for TMDB lookups, by default TMDBCache with default settings
         """
         self.country = country
-        self.api_key = API_KEY
-        self.url = "https://api.themoviedb.org/3/"
+        self.api_key = load_api_key()
+        self.url = "https://api.themoviedb.org/3"
+        self.cache = cache if cache is not None else TMDBCache()
 
         self.headers = {
             "accept": "application/json",
             "Authorization": f"Bearer {self.api_key}",
         }
+        self.client: httpx.AsyncClient | None = None
+        self.limiter = AsyncLimiter(TMDB_RATE_LIMIT, TMDB_RATE_PERIOD)
+
+    async def __aenter__(self) -> "TMDB":
+        """
+        Open HTTP client used by all requests to TMDB API and the cache.
+        Requests can be sent only inside of ``async with TMDB(...)`` block.
+
+        Returns
+        -------
+        TMDB
+            TMDB object with open HTTP client
+        """
+        if self.client is not None:
+            raise RuntimeError("TMDB client is already open")
+
+        # HTTP/2 multiplexes concurrent requests over a single connection
+        self.client = httpx.AsyncClient(
+            http2=True,
+            headers=self.headers,
+            base_url=self.url,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            timeout=TMDB_TIMEOUT,
+        )
+        self.cache.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        client, self.client = self.client, None
+        await client.aclose()
+        self.cache.close()
+
+    async def get_json(self, suffix: str, params: dict | None = None) -> dict | None:
+        """
+        Send rate limited GET request to TMDB API and decode JSON response.
+        Requests that hit the rate limit or fail on the network level are
+        retried with exponential backoff.
 
-    def get_streaming_platforms(self, movie_id: int) -> list[str]:
+        Parameters
+        ----------
+        suffix : str
+            Suffix that will be added to base url
+        params : dict | None, optional
+            Query parameters of the request, by default None
+
+        Returns
+        -------
+        dict | None
+            Decoded JSON response or None if there was an error
+        """
+        if self.client is None:
+            raise RuntimeError("TMDB client is not open, use 'async with TMDB(...)'")
+
+        for attempt in range(TMDB_MAX_RETRIES + 1):
+            delay = 0.5 * 2**attempt
+            last_attempt = attempt == TMDB_MAX_RETRIES
+
+            try:
+                async with self.limiter:
+                    response = await self.client.get(suffix, params=params)
+            except httpx.HTTPError as error:
+                if last_attempt:
+                    logger.error(f"Error from endpoint {suffix}: {error!r}")
+                    return None
+
+                await asyncio.sleep(delay)
+                continue
+
+            if response.status_code == HTTPStatus.OK:
+                try:
+                    return orjson.loads(response.content)
+                except orjson.JSONDecodeError as error:
+                    logger.error(f"Invalid JSON from endpoint {response.url}: {error}")
+                    return None
+
+            if response.status_code != HTTPStatus.TOO_MANY_REQUESTS or last_attempt:
+                logger.error(
+                    f"Error from endpoint {response.url}, "
+                    f"status code: {response.status_code}"
+                )
+                return None
+
+            # Retry-After can also be an HTTP-date, fall back to the backoff then.
+            # It is capped, so a single response can't stall all pending lookups.
+            try:
+                retry_after = float(response.headers.get("Retry-After", 0))
+                delay = min(max(delay, retry_after), TMDB_RATE_PERIOD)
+            except ValueError:
+                pass
+
+            await asyncio.sleep(delay)
+
+    async def get_streaming_platforms(self, movie_id: int) -> list[str]:
         """
         Get streaming platforms for movie from TMDB API.
 
@@ -121,23 +479,22 @@ class TMDB:
         list[str]
             List of streaming platforms
         """
-        suffix = f"movie/{movie_id}/watch/providers"
-        endpoint = f"{self.url}/{suffix}"
-        response = requests.get(endpoint, headers=self.headers)
-
-        if response.status_code != HTTPStatus.OK:
-            logger.error(
-                f"Error from endpoint {endpoint}, status code: {response.status_code}"
-            )
-            return []
-
-        try:
-            streaming_platforms = response.json()["results"][self.country]["flatrate"]
-            return [platform["provider_name"] for platform in streaming_platforms]
-        except KeyError:
-            return []
-
-    def get_movie_id(self, title: str) -> int | None:
+        # Watch providers response contains every country, so it is cached as
+        # a whole and other countries don't need to query TMDB API again
+        results = self.cache.get_watch_providers(movie_id)
+        if results is None:
+            suffix = f"movie/{movie_id}/watch/providers"
+            data = await self.get_json(suffix)
+            if data is None:
+                return []
+
+            results = data.get("results", {})
+            self.cache.set_watch_providers(movie_id, results)
+
+        streaming_platforms = results.get(self.country, {}).get("flatrate", [])
+        return [platform["provider_name"] for platform in streaming_platforms]
+
+    async def get_movie_id(self, title: str) -> int | None:
         """
         Get movie id from TMDB API.
 
@@ -151,24 +508,25 @@ class TMDB:
         int
             Movie id
         """
-        parsed_query = urllib.parse.quote_plus(title)
+        cached = self.cache.get_movie_id(title)
+        if cached is not None:
+            return cached
 
-        suffix = f"search/movie?query={parsed_query}&include_adult=true"
-        endpoint = f"{self.url}/{suffix}"
-        response = requests.get(endpoint, headers=self.headers)
+        params = {"query": title, "include_adult": "true"}
+        data = await self.get_json("search/movie", params=params)
+        if data is None:
+            return None
 
-        if response.status_code != HTTPStatus.OK:
-            logger.error(
-                f"Error from endpoint {endpoint}, status code: {response.status_code}"
-            )
+        if not (results := data.get("results")):
             return None
 
         # NOTE: For now only return first result, but in the future we can
         # do some fuzzy matching and return multiple results
-        movie_id = response.json()["results"][0]["id"]
+        movie_id = results[0]["id"]
+        self.cache.set_movie_id(title, movie_id)
         return movie_id
 
-    def get_movie(self, title: str) -> Movie:
+    async def get_movie(self, title: str) -> Movie:
         """
         Get movie information from TMDB API and return Movie object.
 
@@ -182,15 +540,43 @@ class TMDB:
         Movie
             Movie object
         """
-        movie_id = self.get_movie_id(title)
+        movie_id = await self.get_movie_id(title)
         if movie_id is None:
             return Movie(title, [])
 
-        streaming_platforms = self.get_streaming_platforms(movie_id)
+        streaming_platforms = await self.get_streaming_platforms(movie_id)
         movie = Movie(title, streaming_platforms)
 
         return movie
 
+    async def get_movies(self, titles: list[str]) -> list[Movie]:
+        """
+        Get movie information for all titles concurrently from TMDB API.
+        Duplicated titles are queried only once.
+
+        Parameters
+        ----------
+        titles : list[str]
+            Titles of the movies, used to query TMDB API
+
+        Returns
+        -------
+        list[Movie]
+            List of Movie objects, in the same order as titles
+        """
+        unique_titles = list(dict.fromkeys(titles))
+
+        movies = await atqdm.gather(
+            *(self.get_movie(title) for title in unique_titles),
+            disable=not sys.stderr.isatty(),
+            mininterval=0.5,
+        )
+
+        self.cache.commit()
+
+        seen = dict(zip(unique_titles, movies))
+        return [seen[title] for title in titles]
+
 
 class Letterboxd:
     def __init__(self, username: str, country: str):
@@ -245,59 +631,99 @@ class Letterboxd:
         if _watchlist := getattr(self, "_watchlist", None):
             return _watchlist
 
-        self._watchlist = []
-        current_page = 1
-
-        watchlist_html = self.get_page(current_page)
+        watchlist_html = self.get_page(1)
         if watchlist_html is None:
             return []
 
-        soup = BeautifulSoup(watchlist_html, "html.parser")
-
-        # Returns: 'self.username' WANTS TO SEE 'movies_count' FILMS
-        movies_count = soup.find("h1", {"class": "section-heading"}).text
-        movies_count = int(movies_count.split()[-2])
-        num_of_pages = movies_count // (7 * 4) + 1
+        if page_numbers := [int(page) for page in PAGE_RE.findall(watchlist_html)]:
+            num_of_pages = max(page_numbers)
+        elif count_match := COUNT_RE.search(watchlist_html):
+            # There is no pagination if all movies fit on a single page
+            movies_count = int(count_match.group(1).replace(",", ""))
+            num_of_pages = max(1, math.ceil(movies_count / (7 * 4)))
+        else:
+            logger.warning(
+                f"Could not find movies count for user {self.username}, "
+                "assuming a single watchlist page"
+            )
+            num_of_pages = 1
+
+        # Remaining pages don't depend on each other, so fetch them in parallel
+        pages = [watchlist_html]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = executor.map(self.get_page, range(2, num_of_pages + 1))
+            for page_html in tqdm(
+                results,
+                total=(num_of_pages - 1),
+                disable=not sys.stderr.isatty(),
+                mininterval=0.5,
+            ):
+                if page_html is not None:
+                    pages.append(page_html)
+
+        titles = [title for page_html in pages for title in parse_titles(page_html)]
+
+        self._watchlist = asyncio.run(self.get_movies(titles))
+        return self._watchlist
 
-        with tqdm(total=(num_of_pages - 1)) as pbar:
-            while current_page <= num_of_pages:
-                for movie_el in soup.find_all("li", {"class": "poster-container"}):
-                    # The html is not fully rendered, so we need to get the title
-                    # from the img alt attribute
-                    img = movie_el.find("img")
-                    title = img["alt"]
+    async def get_movies(self, titles: list[str]) -> list[Movie]:
+        """
+        Get movie information for watchlist titles from TMDB API.
 
-                    movie = self.tmdb.get_movie(title)
-                    self._watchlist.append(movie)
+        Parameters
+        ----------
+        titles : list[str]
+            Titles of the movies on user's watchlist
 
-                current_page += 1
-                pbar.update(1)
-                watchlist_html = self.get_page(current_page)
-                soup = BeautifulSoup(watchlist_html, "html.parser")
-        return self._watchlist
+        Returns
+        -------
+        list[Movie]
+            List of Movie objects, in the same order as titles
+        """
+        async with self.tmdb:
+            return await self.tmdb.get_movies(titles)
 
-    @property
-    def summary(self):
-        if _summary := getattr(self, "_summary", None):
-            return _summary
+    def write_summary(self, out: TextIO | None = None):
+        """
+        Write summary of the watchlist movies and platforms they are available
+        on, one movie at a time.
 
+        Parameters
+        ----------
+        out : TextIO | None, optional
+            Stream the summary will be written to, by default sys.stdout
+        """
+        out = out if out is not None else sys.stdout
         watchlist = self.watchlist
-        self._summary = ""
 
         for movie in watchlist:
-            self._summary += str(movie) + "\n"
-            self._summary += "*" * 50 + "\n"
+            out.write(str(movie) + "\n" + SEPARATOR + "\n")
 
-        platforms = [platform for movie in watchlist for platform in movie.platforms]
-        counter = Counter(platforms)
+        counter = Counter(chain.from_iterable(movie.platforms for movie in watchlist))
 
-        self._summary += "Platforms summary \n----------\n"
+        out.write("Platforms summary \n----------\n")
         for platform, count in counter.items():
-            self._summary += f"{platform}: {count}\n"
+            out.write(f"{platform}: {count}\n")
+
+    @property
+    def summary(self) -> str:
+        """
+        Get summary of the watchlist as a string.
+
+        Returns
+        -------
+        str
+            Summary written by write_summary
+        """
+        if _summary := getattr(self, "_summary", None):
+            return _summary
 
+        out = io.StringIO()
+        self.write_summary(out)
+        self._summary = out.getvalue()
         return self._summary
 
 
 if __name__ == "__main__":
     letterboxd = Letterboxd("wombatbat", "PL")
-    print(letterboxd.summary)
+    letterboxd.write_summary()
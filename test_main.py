@@ -0,0 +1,98 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import httpx
+
+os.environ.setdefault("TMDB_API_KEY", "test")
+
+import main  # noqa: E402
+
+
+class TMDBGetJsonTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmdb = main.TMDB("PL", cache=main.TMDBCache(":memory:"))
+        self.responses = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            response = self.responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        self.tmdb.client = httpx.AsyncClient(
+            transport=httpx.MockTransport(handler), base_url=self.tmdb.url
+        )
+        sleep = mock.patch("main.asyncio.sleep", new_callable=mock.AsyncMock)
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+
+    async def asyncTearDown(self):
+        await self.tmdb.client.aclose()
+
+    @property
+    def delays(self) -> list[float]:
+        return [call.args[0] for call in self.sleep.await_args_list]
+
+    async def test_retries_rate_limit_http_date_and_transport_error(self):
+        self.responses = [
+            httpx.Response(429, headers={"Retry-After": "2"}),
+            httpx.Response(
+                429, headers={"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}
+            ),
+            httpx.ConnectError("connection reset"),
+            httpx.Response(200, json={"results": []}),
+        ]
+
+        data = await self.tmdb.get_json("search/movie")
+
+        self.assertEqual(data, {"results": []})
+        self.assertEqual(self.delays, [2, 1, 2])
+
+    async def test_retry_after_is_capped(self):
+        self.responses = [
+            httpx.Response(429, headers={"Retry-After": "3600"}),
+            httpx.Response(200, json={}),
+        ]
+
+        await self.tmdb.get_json("search/movie")
+
+        self.assertEqual(self.delays, [main.TMDB_RATE_PERIOD])
+
+    async def test_gives_up_after_max_retries(self):
+        self.responses = [httpx.ConnectError("connection reset")] * (
+            main.TMDB_MAX_RETRIES + 1
+        )
+
+        self.assertIsNone(await self.tmdb.get_json("search/movie"))
+        self.assertEqual(len(self.delays), main.TMDB_MAX_RETRIES)
+
+    async def test_invalid_json(self):
+        self.responses = [httpx.Response(200, text="<html>Bad gateway</html>")]
+
+        self.assertIsNone(await self.tmdb.get_json("search/movie"))
+
+
+class TMDBCacheTest(unittest.TestCase):
+    def test_entries_are_written_on_commit(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cache.sqlite")
+            cache = main.TMDBCache(path)
+            cache.open()
+            cache.set_movie_id("Up", 14160)
+            cache.set_watch_providers(14160, {"PL": {"flatrate": []}})
+            self.assertEqual(cache.get_movie_id("Up"), 14160)
+            cache.close()
+
+            cache = main.TMDBCache(path)
+            cache.open()
+            self.assertEqual(cache.get_movie_id("Up"), 14160)
+            self.assertEqual(
+                cache.get_watch_providers(14160), {"PL": {"flatrate": []}}
+            )
+            cache.close()
+
+
+if __name__ == "__main__":
+    unittest.main()